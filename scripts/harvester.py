@@ -1,13 +1,21 @@
-import json
+import asyncio
+import functools
 import os
+import sqlite3
 import time
 from pathlib import Path
 
-import googlemaps
+import aiohttp
+import orjson
 from dotenv import load_dotenv
 from tqdm import tqdm
 
 
+SCRIPT_DIR = Path(__file__).resolve().parent
+ENV_LOCAL_PATH = SCRIPT_DIR.parent / ".env.local"
+DETAILS_CACHE_PATH = SCRIPT_DIR / "data" / "places_cache.db"
+DETAILS_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
 ANCHORS = [
     (47.6570, -122.3131),  # South Anchor
     (47.6612, -122.3131),  # Central Anchor
@@ -30,48 +38,171 @@ DETAIL_FIELDS = [
     "editorial_summary",
 ]
 
+NEARBY_SEARCH_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+DETAILS_URL = "https://maps.googleapis.com/maps/api/place/details/json"
+MAX_CONCURRENT_DETAILS = 16
+MAX_REQUEST_ATTEMPTS = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+PROGRESS_MIN_INTERVAL = 0.5
+
+
+def open_details_cache(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS details (place_id TEXT PRIMARY KEY, json TEXT, fetched_at INTEGER)"
+    )
+    return conn
+
+
+def build_session():
+    # One keep-alive pool shared by both phases so TLS handshakes are paid once per socket.
+    connector = aiohttp.TCPConnector(
+        limit=32,
+        limit_per_host=MAX_CONCURRENT_DETAILS,
+        keepalive_timeout=30,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+async def get_json(session, url, params):
+    for attempt in range(MAX_REQUEST_ATTEMPTS):
+        async with session.get(url, params=params) as response:
+            if response.status in RETRY_STATUSES:
+                payload = None
+            else:
+                response.raise_for_status()
+                payload = await response.json()
+
+        if payload is not None and payload.get("status") != "OVER_QUERY_LIMIT":
+            return payload
+
+        # Back off on rate limiting and transient server errors before retrying.
+        if attempt < MAX_REQUEST_ATTEMPTS - 1:
+            await asyncio.sleep(2**attempt)
+
+    raise RuntimeError(f"Gave up on {url} after {MAX_REQUEST_ATTEMPTS} attempts")
 
-def fetch_nearby_places(gmaps_client, location, radius, place_type):
+
+async def fetch_nearby_page(session, params):
+    payload = await get_json(session, NEARBY_SEARCH_URL, params)
+    status = payload.get("status")
+    if status not in ("OK", "ZERO_RESULTS"):
+        raise RuntimeError(f"Nearby search failed with status {status}")
+    return payload
+
+
+async def fetch_nearby_places(session, api_key, location, radius, place_type):
     results = []
-    response = gmaps_client.places_nearby(
-        location=location,
-        radius=radius,
-        type=place_type,
+    response = await fetch_nearby_page(
+        session,
+        {
+            "location": f"{location[0]},{location[1]}",
+            "radius": radius,
+            "type": place_type,
+            "key": api_key,
+        },
     )
     results.extend(response.get("results", []))
 
     next_page_token = response.get("next_page_token")
     while next_page_token:
-        time.sleep(2)
-        response = gmaps_client.places_nearby(
-            location=location,
-            radius=radius,
-            type=place_type,
-            page_token=next_page_token,
-        )
+        # Google only accepts a page token a couple of seconds after issuing it.
+        await asyncio.sleep(2)
+        response = await fetch_nearby_page(session, {"pagetoken": next_page_token, "key": api_key})
         results.extend(response.get("results", []))
         next_page_token = response.get("next_page_token")
 
     return results
 
 
-def enrich_places(gmaps_client, place_ids):
-    enriched = []
-    for place_id in tqdm(place_ids, desc="Enriching places", unit="place"):
-        details = gmaps_client.place(place_id=place_id, fields=DETAIL_FIELDS)
-        result = details.get("result")
-        if result:
-            enriched.append(result)
-    return enriched
+async def fetch_all_nearby_places(session, api_key):
+    results_per_anchor = await asyncio.gather(
+        *(
+            fetch_nearby_places(session, api_key, anchor, RADIUS_METERS, PLACE_TYPE)
+            for anchor in ANCHORS
+        )
+    )
 
+    deduped = {}
+    for nearby in results_per_anchor:
+        for place in nearby:
+            place_id = place.get("place_id")
+            if place_id and place_id not in deduped:
+                deduped[place_id] = place
+    return deduped
 
+
+async def fetch_place_details(session, semaphore, cache, api_key, place_id):
+    row = cache.execute("SELECT json, fetched_at FROM details WHERE place_id = ?", (place_id,)).fetchone()
+    if row and time.time() - row[1] < DETAILS_CACHE_TTL_SECONDS:
+        return orjson.loads(row[0])
+
+    params = {
+        "place_id": place_id,
+        "fields": ",".join(DETAIL_FIELDS),
+        "key": api_key,
+    }
+
+    async with semaphore:
+        payload = await get_json(session, DETAILS_URL, params)
+
+    status = payload.get("status")
+    if status in ("NOT_FOUND", "ZERO_RESULTS"):
+        return None
+    if status != "OK":
+        raise RuntimeError(f"Place details for {place_id} failed with status {status}")
+
+    result = payload.get("result")
+    if result:
+        with cache:
+            cache.execute(
+                "INSERT OR REPLACE INTO details (place_id, json, fetched_at) VALUES (?, ?, ?)",
+                (place_id, orjson.dumps(result).decode("utf-8"), int(time.time())),
+            )
+    return result
+
+
+async def enrich_places_async(session, cache, api_key, place_ids):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DETAILS)
+
+    with tqdm(
+        total=len(place_ids),
+        desc="Enriching places",
+        unit="place",
+        mininterval=PROGRESS_MIN_INTERVAL,
+        smoothing=0,
+    ) as progress:
+
+        async def fetch_one(place_id):
+            result = await fetch_place_details(session, semaphore, cache, api_key, place_id)
+            progress.update(1)
+            return result
+
+        # A failed lookup cancels and awaits the remaining fetches before the session closes.
+        try:
+            async with asyncio.TaskGroup() as fetches:
+                tasks = [fetches.create_task(fetch_one(place_id)) for place_id in place_ids]
+        except ExceptionGroup as group:
+            raise group.exceptions[0] from None
+
+    return [result for task in tasks if (result := task.result())]
+
+
+async def harvest(cache, api_key):
+    async with build_session() as session:
+        deduped = await fetch_all_nearby_places(session, api_key)
+        return await enrich_places_async(session, cache, api_key, list(deduped.keys()))
+
+
+@functools.cache
 def load_secrets_from_env_local():
-    env_local_path = Path(__file__).resolve().parent.parent / ".env.local"
-    if not env_local_path.exists():
-        raise FileNotFoundError(f"Missing env file: {env_local_path}")
+    if not ENV_LOCAL_PATH.exists():
+        raise FileNotFoundError(f"Missing env file: {ENV_LOCAL_PATH}")
 
     # Load all key/value pairs from .env.local into process env.
-    load_dotenv(dotenv_path=env_local_path)
+    load_dotenv(dotenv_path=ENV_LOCAL_PATH)
 
 
 def main():
@@ -81,24 +212,18 @@ def main():
     if not api_key:
         raise RuntimeError("PLACES_API_KEY environment variable is required")
 
-    gmaps_client = googlemaps.Client(key=api_key)
-
-    deduped = {}
-    for anchor in ANCHORS:
-        nearby = fetch_nearby_places(gmaps_client, anchor, RADIUS_METERS, PLACE_TYPE)
-        for place in nearby:
-            place_id = place.get("place_id")
-            if place_id and place_id not in deduped:
-                deduped[place_id] = place
-
-    enriched = enrich_places(gmaps_client, list(deduped.keys()))
+    cache = open_details_cache(DETAILS_CACHE_PATH)
+    try:
+        enriched = asyncio.run(harvest(cache, api_key))
+    finally:
+        cache.close()
 
     output_dir = Path("/Users/divyansh/Desktop/chowdown/chowdown/scripts/data")
     output_dir.mkdir(parents=True, exist_ok=True)
     output_path = output_dir / "raw_places.json"
 
-    with output_path.open("w", encoding="utf-8") as f:
-        json.dump(enriched, f, ensure_ascii=False, indent=2)
+    with output_path.open("wb") as f:
+        f.write(orjson.dumps(enriched, option=orjson.OPT_INDENT_2))
 
 
 if __name__ == "__main__":
@@ -1,18 +1,41 @@
+import asyncio
+import base64
+import functools
+import hashlib
 import json
 import os
+import sqlite3
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 from typing import Any
 
+import ijson
+import numpy as np
+import orjson
+import tiktoken
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 from tenacity import retry, stop_after_attempt, wait_exponential
 from tqdm import tqdm
 
 
 SCRIPT_DIR = Path(__file__).resolve().parent
+ENV_LOCAL_PATH = SCRIPT_DIR.parent / ".env.local"
 DATA_DIR = SCRIPT_DIR / "data"
 INPUT_PATH = DATA_DIR / "raw_places.json"
 OUTPUT_PATH = DATA_DIR / "enriched_places.json"
+CACHE_PATH = DATA_DIR / "refiner_cache.db"
+CHAT_MODEL = "openai/gpt-4o-mini"
+EMBEDDING_MODEL = "text-embedding-3-small"
+MAX_CONCURRENT_PLACES = 32
+EMBEDDING_BATCH_SIZE = 128
+EMBEDDING_BATCH_TOKENS = 16_000
+EMBEDDING_MAX_TOKENS = 8_000
+EMBEDDING_FLUSH_SECONDS = 0.1
+PROGRESS_MIN_INTERVAL = 0.5
+
+# (input index, refined place, embedding input text, token count)
+PendingEmbedding = tuple[int, dict[str, Any], str, int]
 
 SYSTEM_PROMPT = (
     "You are a local Seattle food critic. Analyze the reviews and summary. "
@@ -24,18 +47,43 @@ SYSTEM_PROMPT = (
 )
 
 
+@functools.cache
 def load_secrets_from_env_local() -> None:
-    env_local_path = SCRIPT_DIR.parent / ".env.local"
-    if env_local_path.exists():
-        load_dotenv(dotenv_path=env_local_path)
+    if ENV_LOCAL_PATH.exists():
+        load_dotenv(dotenv_path=ENV_LOCAL_PATH)
 
 
-def build_client() -> OpenAI:
+def open_cache(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS vibes (key TEXT PRIMARY KEY, json TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS embeds (key TEXT PRIMARY KEY, blob BLOB)")
+    return conn
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.blake2b(f"{model}|{text}".encode("utf-8")).hexdigest()
+
+
+def count_places(path: Path) -> int:
+    with path.open("rb") as f:
+        return sum(1 for item in ijson.items(f, "item") if isinstance(item, dict))
+
+
+def load_places(path: Path) -> Iterator[dict[str, Any]]:
+    with path.open("rb") as f:
+        for item in ijson.items(f, "item", use_float=True):
+            if isinstance(item, dict):
+                yield item
+
+
+def build_client() -> AsyncOpenAI:
     api_key = os.getenv("OPENROUTER_API_KEY")
     if not api_key:
         raise RuntimeError("OPENROUTER_API_KEY environment variable is required")
 
-    return OpenAI(
+    return AsyncOpenAI(
         base_url="https://openrouter.ai/api/v1",
         api_key=api_key,
         default_headers={
@@ -61,32 +109,34 @@ def extract_top_reviews_text(place: dict[str, Any], limit: int = 3) -> str:
 
     review_texts: list[str] = []
     for review in reviews:
+        if len(review_texts) >= limit:
+            break
         if not isinstance(review, dict):
             continue
         text = str(review.get("text", "")).strip()
         if text:
             review_texts.append(text)
-        if len(review_texts) >= limit:
-            break
 
     return "\n".join(f"{idx + 1}. {text}" for idx, text in enumerate(review_texts))
 
 
-@retry(reraise=True, stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=20))
-def generate_vibe(client: OpenAI, place: dict[str, Any]) -> dict[str, Any]:
+def build_vibe_prompt(place: dict[str, Any]) -> str:
     name = str(place.get("name", "Unknown Place")).strip()
     editorial_summary = extract_editorial_summary(place)
     top_reviews = extract_top_reviews_text(place)
 
-    user_prompt = (
+    return (
         f"Name: {name}\n"
         f"Editorial Summary: {editorial_summary or 'N/A'}\n"
         f"Top Reviews:\n{top_reviews or 'N/A'}\n\n"
         "Return only strict JSON with keys: summary, tags."
     )
 
-    response = client.chat.completions.create(
-        model="openai/gpt-4o-mini",
+
+@retry(reraise=True, stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=20))
+async def generate_vibe(client: AsyncOpenAI, user_prompt: str) -> dict[str, Any]:
+    response = await client.chat.completions.create(
+        model=CHAT_MODEL,
         response_format={"type": "json_object"},
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
@@ -107,60 +157,200 @@ def generate_vibe(client: OpenAI, place: dict[str, Any]) -> dict[str, Any]:
     if len(tags) > 5:
         tags = tags[:5]
 
-    if not summary:
-        summary = "Popular local spot with a distinct neighborhood vibe."
-    if not tags:
-        tags = ["Seattle", "Neighborhood Gem", "Casual", "Food", "Local Favorite"]
-
     return {"summary": summary, "tags": tags}
 
 
 @retry(reraise=True, stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=1, max=20))
-def get_embedding(client: OpenAI, text: str) -> list[float]:
-    response = client.embeddings.create(
-        input=text,
-        model="text-embedding-3-small",
+async def get_embeddings(client: AsyncOpenAI, texts: list[str]) -> list[list[float]]:
+    response = await client.embeddings.create(
+        input=texts,
+        model=EMBEDDING_MODEL,
     )
-    return response.data[0].embedding
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+async def get_vibe(client: AsyncOpenAI, cache: sqlite3.Connection, place: dict[str, Any]) -> dict[str, Any]:
+    user_prompt = build_vibe_prompt(place)
+    key = cache_key(CHAT_MODEL, SYSTEM_PROMPT + "\n" + user_prompt)
+
+    row = cache.execute("SELECT json FROM vibes WHERE key = ?", (key,)).fetchone()
+    if row:
+        return json.loads(row[0])
+
+    vibe = await generate_vibe(client, user_prompt)
+    if vibe["summary"] and vibe["tags"]:
+        with cache:
+            cache.execute("INSERT OR REPLACE INTO vibes (key, json) VALUES (?, ?)", (key, json.dumps(vibe)))
+
+    # Fallbacks are applied after caching so an empty model reply is retried next run.
+    if not vibe["summary"]:
+        vibe["summary"] = "Popular local spot with a distinct neighborhood vibe."
+    if not vibe["tags"]:
+        vibe["tags"] = ["Seattle", "Neighborhood Gem", "Casual", "Food", "Local Favorite"]
+    return vibe
+
+
+async def embed_texts(
+    client: AsyncOpenAI, cache: sqlite3.Connection, texts: list[str]
+) -> list[list[float] | np.ndarray]:
+    keys = [cache_key(EMBEDDING_MODEL, text) for text in texts]
+    embeddings: dict[str, list[float] | np.ndarray] = {}
+    for key in keys:
+        row = cache.execute("SELECT blob FROM embeds WHERE key = ?", (key,)).fetchone()
+        if row:
+            embeddings[key] = np.frombuffer(row[0], dtype=np.float32)
+
+    missing = [(key, text) for key, text in zip(keys, texts) if key not in embeddings]
+    if missing:
+        fetched = await get_embeddings(client, [text for _, text in missing])
+        with cache:
+            for (key, _), embedding in zip(missing, fetched):
+                embeddings[key] = embedding
+                cache.execute(
+                    "INSERT OR REPLACE INTO embeds (key, blob) VALUES (?, ?)",
+                    (key, np.asarray(embedding, dtype=np.float32).tobytes()),
+                )
+
+    return [embeddings[key] for key in keys]
+
+
+def encode_embedding(embedding: list[float] | np.ndarray) -> str:
+    # Stored as base64 float16 to keep enriched_places.json small; upload.py dequantizes.
+    quantized = np.asarray(embedding, dtype=np.float32).astype(np.float16)
+    return base64.b64encode(quantized.tobytes()).decode("ascii")
+
+
+@functools.cache
+def embedding_encoding() -> tiktoken.Encoding:
+    # Loaded on first use; tiktoken may need to download the BPE file.
+    return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+
+def build_embedding_input(place: dict[str, Any]) -> tuple[str, int]:
+    text = f"{place['name']}: {place['reviews_summary']} {', '.join(place['tags'])}"
+    encoding = embedding_encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) > EMBEDDING_MAX_TOKENS:
+        # Truncate client-side instead of letting the endpoint reject the whole batch.
+        tokens = tokens[:EMBEDDING_MAX_TOKENS]
+        text = encoding.decode(tokens)
+    return text, len(tokens)
+
+
+async def refine_place(client: AsyncOpenAI, cache: sqlite3.Connection, place: dict[str, Any]) -> dict[str, Any]:
+    vibe = await get_vibe(client, cache, place)
+
+    return {
+        "id": place.get("place_id"),
+        "name": str(place.get("name", "")).strip(),
+        "address": place.get("formatted_address"),
+        "price_level": place.get("price_level"),
+        "rating": place.get("rating"),
+        "reviews_summary": vibe["summary"],
+        "tags": vibe["tags"],
+    }
+
+
+async def next_embedding_batch(
+    queue: asyncio.Queue[PendingEmbedding | None],
+) -> tuple[list[PendingEmbedding], bool]:
+    batch: list[PendingEmbedding] = []
+    batch_tokens = 0
+    item = await queue.get()
+    while item is not None:
+        batch.append(item)
+        batch_tokens += item[3]
+        if len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens >= EMBEDDING_BATCH_TOKENS:
+            return batch, False
+        try:
+            item = await asyncio.wait_for(queue.get(), EMBEDDING_FLUSH_SECONDS)
+        except TimeoutError:
+            # Flush a partial batch rather than stall while vibes trickle in.
+            return batch, False
+    return batch, True
+
+
+async def embed_places(
+    client: AsyncOpenAI,
+    cache: sqlite3.Connection,
+    queue: asyncio.Queue[PendingEmbedding | None],
+) -> list[tuple[int, dict[str, Any]]]:
+    embedded_places: list[tuple[int, dict[str, Any]]] = []
+    done = False
+    while not done:
+        batch, done = await next_embedding_batch(queue)
+        if not batch:
+            continue
+
+        try:
+            embeddings = await embed_texts(client, cache, [text for _, _, text, _ in batch])
+        except Exception as exc:
+            tqdm.write(f"Skipping {len(batch)} places in embedding batch: {exc}")
+            continue
+
+        for (index, place, _, _), embedding in zip(batch, embeddings):
+            place["embedding"] = encode_embedding(embedding)
+            place["embedding_dtype"] = "fp16"
+            embedded_places.append((index, place))
+
+    return embedded_places
+
+
+async def refine_places(
+    client: AsyncOpenAI, cache: sqlite3.Connection, places: Iterable[dict[str, Any]], total: int | None = None
+) -> list[dict[str, Any]]:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_PLACES)
+    queue: asyncio.Queue[PendingEmbedding | None] = asyncio.Queue()
+
+    with tqdm(
+        total=total, desc="Refining places", unit="place", mininterval=PROGRESS_MIN_INTERVAL, smoothing=0
+    ) as progress:
+
+        async def process(index: int, place: dict[str, Any]) -> None:
+            try:
+                refined = await refine_place(client, cache, place)
+                embedding_input, token_count = build_embedding_input(refined)
+            except Exception as exc:
+                place_name = place.get("name", "Unknown Place")
+                tqdm.write(f"Skipping {place_name}: {exc}")
+                return
+            finally:
+                semaphore.release()
+                progress.update(1)
+            await queue.put((index, refined, embedding_input, token_count))
+
+        # Embedding batches are sent while later vibes are still in flight.
+        async with asyncio.TaskGroup() as pipeline:
+            embedder = pipeline.create_task(embed_places(client, cache, queue))
+            async with asyncio.TaskGroup() as producers:
+                for index, place in enumerate(places):
+                    # Acquiring before spawning keeps only the in-flight places parsed in memory.
+                    await semaphore.acquire()
+                    producers.create_task(process(index, place))
+            await queue.put(None)
+
+    return [place for _, place in sorted(embedder.result(), key=lambda item: item[0])]
 
 
 def main() -> None:
     load_secrets_from_env_local()
     client = build_client()
+    # Load the tokenizer up front so a failed download aborts before any API spend.
+    embedding_encoding()
 
-    with INPUT_PATH.open("r", encoding="utf-8") as f:
-        places = json.load(f)
+    # A cheap streaming pass gives the progress bar a total without holding places in memory.
+    total = count_places(INPUT_PATH)
+    places = load_places(INPUT_PATH)
 
-    enriched_places: list[dict[str, Any]] = []
-
-    for place in tqdm(places, desc="Refining places", unit="place"):
-        try:
-            vibe = generate_vibe(client, place)
-            name = str(place.get("name", "")).strip()
-            summary = vibe["summary"]
-            tags = vibe["tags"]
-
-            embedding_input = f"{name}: {summary} {', '.join(tags)}"
-            embedding = get_embedding(client, embedding_input)
-
-            enriched_place = {
-                "id": place.get("place_id"),
-                "name": name,
-                "address": place.get("formatted_address"),
-                "price_level": place.get("price_level"),
-                "rating": place.get("rating"),
-                "reviews_summary": summary,
-                "tags": tags,
-                "embedding": embedding,
-            }
-            enriched_places.append(enriched_place)
-        except Exception as exc:
-            place_name = place.get("name", "Unknown Place")
-            tqdm.write(f"Skipping {place_name}: {exc}")
+    cache = open_cache(CACHE_PATH)
+    try:
+        enriched_places = asyncio.run(refine_places(client, cache, places, total))
+    finally:
+        cache.close()
 
     OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with OUTPUT_PATH.open("w", encoding="utf-8") as f:
-        json.dump(enriched_places, f, ensure_ascii=False, indent=2)
+    with OUTPUT_PATH.open("wb") as f:
+        f.write(orjson.dumps(enriched_places, option=orjson.OPT_INDENT_2))
 
     print(f"Saved {len(enriched_places)} enriched places to {OUTPUT_PATH}")
 
@@ -1,33 +1,53 @@
-import json
+import asyncio
+import base64
+import functools
+import itertools
 import os
+import re
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 from typing import Any
 
+import httpx
+import ijson
+import numpy as np
+import orjson
+import psycopg
 from dotenv import load_dotenv
-from supabase import Client, create_client
 
 
 SCRIPT_DIR = Path(__file__).resolve().parent
+ENV_LOCAL_PATH = SCRIPT_DIR.parent / ".env.local"
 DATA_PATH = SCRIPT_DIR / "data" / "enriched_places.json"
 BATCH_SIZE = 50
-ALLOWED_DB_COLUMNS = {
-    "name",
-    "address",
-    "price_level",
-    "rating",
-    "review_summary",
-    "vibe_tags",
-    "embedding",
-}
-
-
+MAX_CONCURRENT_UPLOADS = 8
+MAX_UPLOAD_ATTEMPTS = 4
+# (db column, enriched_places.json key) pairs; embedding is decoded separately.
+FIELD_MAP = (
+    ("name", "name"),
+    ("address", "address"),
+    ("price_level", "price_level"),
+    ("rating", "rating"),
+    ("review_summary", "reviews_summary"),
+    ("vibe_tags", "tags"),
+)
+DB_COLUMNS = tuple(column for column, _ in FIELD_MAP) + ("embedding",)
+SCHEMA_ERROR_MARKERS = (
+    "could not find",
+    "column",
+    "schema",
+    "does not exist",
+)
+SCHEMA_ERROR_PATTERN = re.compile("|".join(re.escape(marker) for marker in SCHEMA_ERROR_MARKERS))
+
+
+@functools.cache
 def load_secrets_from_env_local() -> None:
-    env_local_path = SCRIPT_DIR.parent / ".env.local"
-    if env_local_path.exists():
-        load_dotenv(dotenv_path=env_local_path)
+    if ENV_LOCAL_PATH.exists():
+        load_dotenv(dotenv_path=ENV_LOCAL_PATH)
 
 
-def build_supabase_client() -> Client:
+def build_rest_target() -> tuple[str, dict[str, str]]:
     url = os.getenv("SUPABASE_URL")
     key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
@@ -36,95 +56,183 @@ def build_supabase_client() -> Client:
     if not key:
         raise RuntimeError("SUPABASE_SERVICE_ROLE_KEY environment variable is required")
 
-    return create_client(url, key)
+    headers = {
+        "apikey": key,
+        "Authorization": f"Bearer {key}",
+        "Content-Type": "application/json",
+        "Prefer": "resolution=merge-duplicates",
+    }
+    return f"{url.rstrip('/')}/rest/v1/places", headers
 
 
-def load_places(path: Path) -> list[dict[str, Any]]:
+def load_places(path: Path) -> Iterator[dict[str, Any]]:
     if not path.exists():
         raise FileNotFoundError(f"Missing data file: {path}")
 
-    with path.open("r", encoding="utf-8") as f:
-        data = json.load(f)
+    with path.open("rb") as f:
+        events = ijson.parse(f, use_float=True)
+        _, event, _ = next(events)
+        if event != "start_array":
+            raise ValueError("enriched_places.json must contain a JSON array")
 
-    if not isinstance(data, list):
-        raise ValueError("enriched_places.json must contain a JSON array")
+        for item in ijson.items(events, "item"):
+            if isinstance(item, dict):
+                yield item
 
-    places: list[dict[str, Any]] = []
-    for item in data:
-        if isinstance(item, dict):
-            places.append(item)
 
-    return places
+def decode_embedding(item: dict[str, Any]) -> np.ndarray | None:
+    embedding = item.get("embedding")
+    if embedding is None:
+        return None
+    if item.get("embedding_dtype") == "fp16" and isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype=np.float16).astype(np.float32)
+    return np.asarray(embedding, dtype=np.float32)
 
 
 def map_to_db_record(item: dict[str, Any]) -> dict[str, Any]:
-    db_record = {
-        "name": item.get("name"),
-        "address": item.get("address"),
-        "price_level": item.get("price_level"),
-        "rating": item.get("rating"),
-        "review_summary": item.get("reviews_summary"),
-        "vibe_tags": item.get("tags"),
-        "embedding": item.get("embedding"),
-    }
+    db_record = {column: item.get(key) for column, key in FIELD_MAP}
+    db_record["embedding"] = decode_embedding(item)
+    return db_record
+
+
+def chunked(items: Iterable[dict[str, Any]], size: int) -> Iterator[list[dict[str, Any]]]:
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def normalize_embeddings(batch: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    records = [record for record in batch if record["embedding"] is not None]
+    if not records:
+        return batch
+
+    # Re-normalize the whole batch at once; fp16 storage drifts the unit norm slightly.
+    matrix = np.stack([record["embedding"] for record in records])
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    for record, embedding in zip(records, matrix):
+        record["embedding"] = embedding
+    return batch
+
 
-    return {key: value for key, value in db_record.items() if key in ALLOWED_DB_COLUMNS}
+@functools.cache
+def vector_template(dimensions: int) -> str:
+    return "[" + ",".join(["%.6g"] * dimensions) + "]"
 
 
-def map_all_records(items: list[dict[str, Any]]) -> list[dict[str, Any]]:
-    mapped_records: list[dict[str, Any]] = []
-    for item in items:
-        mapped_records.append(map_to_db_record(item))
-    return mapped_records
+def format_vector(embedding: np.ndarray | None) -> str | None:
+    if embedding is None:
+        return None
+    return vector_template(len(embedding)) % tuple(embedding.tolist())
 
 
-def chunked(items: list[dict[str, Any]], size: int) -> list[list[dict[str, Any]]]:
-    return [items[i : i + size] for i in range(0, len(items), size)]
+def copy_records(db_url: str, batches: Iterable[list[dict[str, Any]]]) -> int:
+    columns = ", ".join(DB_COLUMNS)
+    copied = 0
+    with psycopg.connect(db_url) as conn:
+        with conn.cursor() as cursor:
+            with cursor.copy(f"COPY places ({columns}) FROM STDIN") as copy:
+                for batch in batches:
+                    for record in batch:
+                        row = [record[column] for column in DB_COLUMNS]
+                        row[-1] = format_vector(row[-1])
+                        copy.write_row(row)
+                    copied += len(batch)
+    return copied
 
 
 def is_schema_error(error: Exception) -> bool:
-    message = str(error).lower()
-    schema_markers = [
-        "could not find",
-        "column",
-        "schema",
-        "does not exist",
-    ]
-    return any(marker in message for marker in schema_markers)
+    return SCHEMA_ERROR_PATTERN.search(str(error).lower()) is not None
+
+
+async def post_batch(client: httpx.AsyncClient, url: str, batch: list[dict[str, Any]]) -> None:
+    for attempt in range(MAX_UPLOAD_ATTEMPTS):
+        response = await client.post(url, content=orjson.dumps(batch, option=orjson.OPT_SERIALIZE_NUMPY))
+        if response.status_code == 429 and attempt < MAX_UPLOAD_ATTEMPTS - 1:
+            await asyncio.sleep(2**attempt)
+            continue
+        if response.is_error:
+            # PostgREST puts the useful detail (e.g. missing columns) in the body.
+            raise RuntimeError(f"{response.status_code} {response.text}")
+        return
+
+
+async def upload_batches(
+    url: str, headers: dict[str, str], batches: Iterable[list[dict[str, Any]]]
+) -> tuple[int, int, Exception | None]:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    schema_mismatch = asyncio.Event()
+    uploaded_count = 0
+    failed_batches = 0
+    source_error: Exception | None = None
+
+    async def upload(client: httpx.AsyncClient, batch_index: int, batch: list[dict[str, Any]]) -> None:
+        nonlocal uploaded_count, failed_batches
+        try:
+            await post_batch(client, url, batch)
+            uploaded_count += len(batch)
+            print(f"✅ Batch {batch_index} uploaded")
+        except Exception as batch_error:
+            failed_batches += 1
+            print(f"❌ Batch {batch_index} failed: {batch_error}")
+            if is_schema_error(batch_error) and not schema_mismatch.is_set():
+                print("Stopping upload due to schema mismatch.")
+                schema_mismatch.set()
+        finally:
+            semaphore.release()
+
+    limits = httpx.Limits(max_connections=MAX_CONCURRENT_UPLOADS)
+    async with httpx.AsyncClient(headers=headers, http2=True, limits=limits, timeout=30) as client:
+        async with asyncio.TaskGroup() as uploads:
+            numbered_batches = enumerate(batches, start=1)
+            while True:
+                await semaphore.acquire()
+                if schema_mismatch.is_set():
+                    break
+                try:
+                    batch_index, batch = next(numbered_batches)
+                except StopIteration:
+                    break
+                except Exception as exc:
+                    # Keep read errors out of the TaskGroup so in-flight uploads still finish.
+                    source_error = exc
+                    break
+                print(f"Uploading batch {batch_index}...")
+                uploads.create_task(upload(client, batch_index, batch))
+
+    return uploaded_count, failed_batches, source_error
 
 
 def main() -> None:
     try:
         load_secrets_from_env_local()
-        supabase = build_supabase_client()
         source_places = load_places(DATA_PATH)
-        places = map_all_records(source_places)
+        first_place = next(source_places, None)
 
-        if not places:
+        if first_place is None:
             print("No places to upload.")
             return
 
-        batches = chunked(places, BATCH_SIZE)
-        uploaded_count = 0
-        failed_batches = 0
+        places = map(map_to_db_record, itertools.chain([first_place], source_places))
+        batches = map(normalize_embeddings, chunked(places, BATCH_SIZE))
 
-        for batch_index, batch in enumerate(batches, start=1):
-            try:
-                print(f"Uploading batch {batch_index}...")
-                supabase.table("places").upsert(batch).execute()
-                uploaded_count += len(batch)
-                print("✅ Batch uploaded")
-            except Exception as batch_error:
-                failed_batches += 1
-                print(f"❌ Batch {batch_index} failed: {batch_error}")
-                if is_schema_error(batch_error):
-                    print("Stopping upload due to schema mismatch.")
-                    break
+        # A direct database URL lets us bulk load with COPY instead of PostgREST.
+        db_url = os.getenv("SUPABASE_DB_URL")
+        if db_url:
+            print("Copying places...")
+            uploaded_count = copy_records(db_url, batches)
+            print(f"✅ Successfully uploaded {uploaded_count} places to Supabase.")
+            return
+
+        url, headers = build_rest_target()
+        uploaded_count, failed_batches, source_error = asyncio.run(upload_batches(url, headers, batches))
 
         if uploaded_count > 0:
             print(f"✅ Successfully uploaded {uploaded_count} places to Supabase.")
         if failed_batches > 0:
             print(f"Completed with {failed_batches} failed batch(es).")
+        if source_error is not None:
+            print(f"❌ Upload stopped early reading {DATA_PATH.name}: {source_error}")
     except Exception as exc:
         print(f"❌ Upload failed: {exc}")
 